@@ -1,61 +1,123 @@
 #!python3
 
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Dict, Optional, Tuple
+from typing import List, Optional, Tuple
+import asyncio
+import hashlib
+import io
+import json
 import os
 import random
 import re
 
-from bs4 import BeautifulSoup
-from PIL import Image
+from PIL import features, Image
+import httpx
 from rich import print
-from rich.progress import track
+from rich.progress import Progress
+from telegram.constants import StickerFormat, StickerSetLimit
 import telegram
+from requests.adapters import HTTPAdapter
 import requests
 import typer
 
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=16))
 
-def create_telegram_sticker_set(
-    sticker_data: Dict[str, Dict],
+_CACHE_DIRECTORY = Path(os.path.expanduser("~/.cache/lstt"))
+
+_EMOJIS = ("🔴", "🟠", "🟡", "🟢", "🔵", "🟣")
+
+_URL_RE = re.compile(
+    rb"background-image:url\((https://stickershop\.line-scdn\.net/"
+    rb"stickershop/v\d+/sticker/(\d+)/android/sticker\.png)"
+)
+
+_QUANTIZE_METHOD = (
+    Image.Quantize.LIBIMAGEQUANT
+    if features.check_feature("libimagequant")
+    else Image.Quantize.MEDIANCUT
+)
+
+
+@dataclass
+class Stickers:
+    """
+    Sticker data, stored column-wise: the i-th sticker has id ``sids[i]``,
+    URL ``urls[i]``, and so on. The stages of the pipeline refer to stickers
+    by their index. A path is ``None`` until the corresponding stage has
+    succeeded for that sticker.
+    """
+
+    sids: List[str]
+    urls: List[str]
+    raw_paths: List[Optional[Path]] = field(init=False)
+    resized_paths: List[Optional[Path]] = field(init=False)
+
+    def __len__(self) -> int:
+        return len(self.sids)
+
+    def __post_init__(self) -> None:
+        self.raw_paths = [None] * len(self.sids)
+        self.resized_paths = [None] * len(self.sids)
+
+
+async def create_telegram_sticker_set(
+    stickers: Stickers,
+    queue: asyncio.Queue,
+    progress: Progress,
     telegram_token: str,
     telegram_user_id: int,
     sticker_set_name: str,
     sticker_set_title: str,
-) -> Tuple[Dict[str, Dict], Optional[str]]:
+) -> Tuple[Stickers, Optional[str]]:
     """
-    Creates the Telegram sticker set
+    Creates the Telegram sticker set, uploading stickers as their indices come
+    out of `queue`, until `None` is received. The first stickers are sent in
+    a single set creation request, and the remaining ones are added
+    concurrently (at most 4 requests at a time). If Telegram rejects that
+    first request, the set is created one sticker at a time instead.
 
     Returns:
-        A tuple containing the sticker data dict, and the real name of the
-        sticker set, or ``None`` if it wasn't created.
+        A tuple containing the sticker data, and the real name of the sticker
+        set, or ``None`` if it wasn't created.
     """
-    bot = telegram.Bot(telegram_token)
-    sticker_set_name += "_by_" + bot.username
-    created = False
-    for sid in track(sticker_data.keys(), "🔼 Uploading..."):
-        path = sticker_data[sid]["resized_path"]
-        if path is None:
-            continue
-        sticker = open(path, "rb")
-        emoji = random.choice("🔴🟠🟡🟢🔵🟣")
-        try:
-            if created:
-                bot.add_sticker_to_set(
-                    telegram_user_id,
-                    sticker_set_name,
-                    emoji,
-                    sticker,
-                )
-            else:
-                bot.create_new_sticker_set(
-                    telegram_user_id,
-                    sticker_set_name,
-                    sticker_set_title,
-                    emoji,
-                    sticker,
-                )
-        except telegram.TelegramError as error:
-            if created:
+    loop = asyncio.get_running_loop()
+    task = progress.add_task("🔼 Uploading...", total=len(stickers))
+    max_initial_stickers = StickerSetLimit.MAX_INITIAL_STICKERS
+    # Limits the number of concurrent add_sticker_to_set requests, to stay
+    # clear of Telegram's rate limits
+    semaphore = asyncio.Semaphore(4)
+    emojis = iter(random.choices(_EMOJIS, k=len(stickers)))
+    async with telegram.Bot(telegram_token) as bot:
+        sticker_set_name += "_by_" + bot.username
+
+        async def _input_sticker(path: Path) -> telegram.InputSticker:
+            # Passing the bytes rather than a file object means no file
+            # descriptor is left open, and retries don't hit the disk again.
+            # The file is read in a thread to not block the other uploads.
+            data = await loop.run_in_executor(None, path.read_bytes)
+            return telegram.InputSticker(
+                data,
+                emoji_list=[next(emojis)],
+                format=StickerFormat.STATIC,
+            )
+
+        async def _add(
+            path: Path,
+            sticker: Optional[telegram.InputSticker] = None,
+        ) -> None:
+            try:
+                if sticker is None:
+                    sticker = await _input_sticker(path)
+                async with semaphore:
+                    await bot.add_sticker_to_set(
+                        telegram_user_id,
+                        sticker_set_name,
+                        sticker,
+                    )
+            except telegram.error.TelegramError as error:
                 print(
                     "🔼❌ [red]Couldn't add sticker[/red]",
                     str(path),
@@ -63,61 +125,211 @@ def create_telegram_sticker_set(
                     f"({type(error).__name__})",
                     str(error),
                 )
-            else:
-                print(
-                    "🔼❌ [red]Couldn't create sticker set:[/red]",
-                    f"({type(error).__name__})",
-                    str(error),
+            progress.advance(task)
+
+        async def _create(
+            paths: List[Path],
+            input_stickers: List[telegram.InputSticker],
+        ) -> None:
+            # The default write timeout (20 seconds) is too short to send up
+            # to 50 stickers on a slow link, so allow one more second per
+            # 64 KiB, i.e. an upload speed of about 0.5 Mbit/s
+            size = sum(path.stat().st_size for path in paths)
+            try:
+                await bot.create_new_sticker_set(
+                    telegram_user_id,
+                    sticker_set_name,
+                    sticker_set_title,
+                    input_stickers,
+                    write_timeout=20 + size / 65536,
                 )
-                # If creation failed, abort
-                print("[red]Aborting... ☹️[/red]")
-                break
-        created = True
-    return sticker_data, sticker_set_name if created else None
+            except telegram.error.TimedOut:
+                # The request can time out after Telegram has created the set
+                if not await _set_exists():
+                    raise
 
+        async def _set_exists() -> bool:
+            try:
+                await bot.get_sticker_set(sticker_set_name)
+            except telegram.error.TelegramError:
+                return False
+            return True
 
-def download_stickers(
-    sticker_data: Dict[str, Dict],
+        # The set is created with as many stickers as the API allows in a
+        # single request, the remaining ones are added afterwards. Stickers
+        # come out of the queue in the order they finish, so they are sorted
+        # back by index to keep the order of the LINE page.
+        initial: List[Tuple[int, Path]] = []
+        while (
+            len(initial) < max_initial_stickers
+            and (i := await queue.get()) is not None
+        ):
+            if (path := stickers.resized_paths[i]) is None:
+                progress.advance(task)
+            else:
+                initial.append((i, path))
+        initial_paths = [path for _, path in sorted(initial)]
+        if not initial_paths:
+            return stickers, None
+        initial_stickers = await asyncio.gather(
+            *[_input_sticker(path) for path in initial_paths]
+        )
+        created = False
+        try:
+            await _create(initial_paths, initial_stickers)
+            created = True
+            progress.advance(task, len(initial_paths))
+        except telegram.error.BadRequest as error:
+            print(
+                "🔼❌ [red]Couldn't create sticker set in one request:[/red]",
+                f"({type(error).__name__})",
+                str(error),
+            )
+            # A single invalid sticker makes the whole request fail, so the
+            # set is created with the first sticker that Telegram accepts,
+            # and the others are added one by one
+            print("[red]Retrying one sticker at a time...[/red]")
+            pending = list(zip(initial_paths, initial_stickers))
+            while pending and not created:
+                path, sticker = pending.pop(0)
+                try:
+                    await _create([path], [sticker])
+                    created = True
+                except telegram.error.TelegramError as error:
+                    print(
+                        "🔼❌ [red]Couldn't create sticker set with[/red]",
+                        str(path),
+                        ":",
+                        f"({type(error).__name__})",
+                        str(error),
+                    )
+                    if not isinstance(error, telegram.error.BadRequest):
+                        break
+                progress.advance(task)
+            if created:
+                for path, sticker in pending:
+                    await _add(path, sticker)
+        except telegram.error.TelegramError as error:
+            print(
+                "🔼❌ [red]Couldn't create sticker set:[/red]",
+                f"({type(error).__name__})",
+                str(error),
+            )
+        if not created:
+            # If creation failed, abort
+            print("[red]Aborting... ☹️[/red]")
+            return stickers, None
+        # If fewer than max_initial_stickers were collected, the queue is
+        # already exhausted
+        tasks = []
+        if len(initial_paths) == max_initial_stickers:
+            while (i := await queue.get()) is not None:
+                if (path := stickers.resized_paths[i]) is None:
+                    progress.advance(task)
+                else:
+                    tasks.append(asyncio.create_task(_add(path)))
+        await asyncio.gather(*tasks)
+    return stickers, sticker_set_name
+
+
+async def download_stickers(
+    stickers: Stickers,
     download_directory: Path,
-) -> Dict[str, Dict]:
-    """Downloads the stickers"""
+    queue: asyncio.Queue,
+    progress: Progress,
+) -> Stickers:
+    """
+    Downloads the stickers concurrently. The index of each sticker is put in
+    `queue` once it is downloaded (or failed to), and `None` is put last.
+
+    The ETag of each sticker is saved next to it, so that subsequent runs
+    send a conditional request and keep the file on a 304 response.
+    """
     if not os.path.isdir(download_directory):
         os.mkdir(download_directory)
-    for sid in track(sticker_data.keys(), "🔽 Downloading..."):
-        url = sticker_data[sid]["url"]
-        file_path = download_directory / f"{sid}.png"
+
+    async def _fetch(client: httpx.AsyncClient, i: int) -> None:
+        url = stickers.urls[i]
+        file_path = download_directory / f"{stickers.sids[i]}.png"
+        etag_path = file_path.with_suffix(".etag")
+        headers = {}
+        if file_path.is_file() and etag_path.is_file():
+            headers["If-None-Match"] = etag_path.read_text()
         try:
-            response = requests.get(url)
-            response.raise_for_status()
-            with open(file_path, "wb") as file:
-                file.write(response.content)
-            sticker_data[sid]["raw_path"] = file_path
-        except requests.HTTPError as error:
-            sticker_data[sid]["raw_path"] = None
+            async with client.stream("GET", url, headers=headers) as response:
+                if response.status_code != httpx.codes.NOT_MODIFIED:
+                    response.raise_for_status()
+                    # The sidecar is only written back once the file is
+                    # complete, so that a truncated download is refetched
+                    etag_path.unlink(missing_ok=True)
+                    with open(file_path, "wb") as file:
+                        async for chunk in response.aiter_bytes(65536):
+                            file.write(chunk)
+                    if "ETag" in response.headers:
+                        etag_path.write_text(response.headers["ETag"])
+            stickers.raw_paths[i] = file_path
+        except httpx.HTTPError as error:
+            # Covers both HTTP error statuses and transport errors (timeouts,
+            # dropped connections...), the sticker is just skipped
             print(
                 "🔽❌ [red]Couldn't download sticker[/red]",
                 url,
                 ":",
+                f"({type(error).__name__})",
                 str(error),
             )
-    return sticker_data
+        progress.advance(task)
+        await queue.put(i)
 
+    task = progress.add_task("🔽 Downloading...", total=len(stickers))
+    # All stickers are served by the same CDN host, so with HTTP/2 they are
+    # multiplexed over a single connection
+    async with httpx.AsyncClient(
+        http2=True,
+        follow_redirects=True,
+        limits=httpx.Limits(max_connections=8),
+        # Requests may legitimately queue for a free connection, so there is
+        # no limit on how long they wait for one
+        timeout=httpx.Timeout(10, pool=None),
+    ) as client:
+        await asyncio.gather(
+            *[_fetch(client, i) for i in range(len(stickers))]
+        )
+    await queue.put(None)
+    return stickers
 
-def get_stickers_urls(line_sticker_url: str) -> Dict[str, Dict]:
-    """Retrives all the sticker URLs from the sticker page"""
-    response = requests.get(line_sticker_url)
-    response.raise_for_status()
-    soup = BeautifulSoup(response.text, "html.parser")
-    tags = soup.find_all(attrs={"class": re.compile(".* FnPreview$")})
-    sticker_data = dict()
-    pattern = (
-        "background-image:url\((https://stickershop.line-scdn.net/stickershop/"
-        "v\d+/sticker/(\d+)/android/sticker.png);compress=true\);"
+
+def get_stickers_urls(line_sticker_url: str) -> Stickers:
+    """
+    Retrives all the sticker URLs from the sticker page. Each sticker preview
+    has a ``background-image:url(...)`` style, so a single regex scan over the
+    raw page is enough, no need to parse the HTML.
+
+    The result is cached in `_CACHE_DIRECTORY` along with the ETag of the
+    page, so that subsequent runs send a conditional request and skip the
+    parsing on a 304 response.
+    """
+    cache_path = _CACHE_DIRECTORY / (
+        hashlib.sha1(line_sticker_url.encode()).hexdigest() + ".json"
     )
-    for tag in tags:
-        if match := re.search(pattern, tag["style"]):
-            sticker_data[match.group(2)] = {"url": match.group(1)}
-    return sticker_data
+    headers = {}
+    if cache_path.is_file():
+        cache = json.loads(cache_path.read_text())
+        headers["If-None-Match"] = cache["etag"]
+    response = _SESSION.get(line_sticker_url, headers=headers, timeout=10)
+    response.raise_for_status()
+    if response.status_code == requests.codes.not_modified:
+        urls = cache["urls"]
+    else:
+        urls = {
+            match.group(2).decode(): match.group(1).decode()
+            for match in _URL_RE.finditer(response.content)
+        }
+        if "ETag" in response.headers:
+            cache = {"etag": response.headers["ETag"], "urls": urls}
+            _CACHE_DIRECTORY.mkdir(parents=True, exist_ok=True)
+            cache_path.write_text(json.dumps(cache))
+    return Stickers(sids=list(urls.keys()), urls=list(urls.values()))
 
 
 def main(
@@ -152,15 +364,16 @@ def main(
     ),
 ):
     """Main function (duh)"""
-    sticker_data = get_stickers_urls(sticker_page_url)
-    sticker_data = download_stickers(sticker_data, download_directory)
-    sticker_data = resize_stickers(sticker_data, download_directory)
-    sticker_data, real_sticker_set_name = create_telegram_sticker_set(
-        sticker_data,
-        telegram_token,
-        telegram_user_id,
-        sticker_set_name,
-        sticker_set_title,
+    stickers = get_stickers_urls(sticker_page_url)
+    stickers, real_sticker_set_name = asyncio.run(
+        pipeline(
+            stickers,
+            download_directory,
+            telegram_token,
+            telegram_user_id,
+            sticker_set_name,
+            sticker_set_title,
+        )
     )
     if real_sticker_set_name is not None:
         print("✨ All done! ✨")
@@ -170,28 +383,136 @@ def main(
         )
 
 
-def resize_stickers(
-    sticker_data: Dict[str, Dict],
+async def pipeline(
+    stickers: Stickers,
     download_directory: Path,
-) -> Dict[str, Dict]:
+    telegram_token: str,
+    telegram_user_id: int,
+    sticker_set_name: str,
+    sticker_set_title: str,
+) -> Tuple[Stickers, Optional[str]]:
+    """
+    Downloads, resizes, and uploads the stickers. The three stages run
+    concurrently and hand sticker indices over to each other through queues, so
+    that a sticker can be resized or uploaded while others are still being
+    downloaded.
+
+    Returns:
+        Same as `create_telegram_sticker_set`.
+    """
+    download_queue: asyncio.Queue = asyncio.Queue()
+    upload_queue: asyncio.Queue = asyncio.Queue()
+    with Progress() as progress:
+        _, _, result = await asyncio.gather(
+            download_stickers(
+                stickers,
+                download_directory,
+                download_queue,
+                progress,
+            ),
+            resize_stickers(
+                stickers,
+                download_directory,
+                download_queue,
+                upload_queue,
+                progress,
+            ),
+            create_telegram_sticker_set(
+                stickers,
+                upload_queue,
+                progress,
+                telegram_token,
+                telegram_user_id,
+                sticker_set_name,
+                sticker_set_title,
+            ),
+        )
+    return result
+
+
+def _resize_one(raw_path: Path, resized_path: Path) -> Path:
+    """Resizes a single sticker, see `resize_stickers`"""
+    raw = Image.open(raw_path)
+    coefficient = max(raw.width, raw.height) / 512
+    size = (int(raw.width / coefficient), int(raw.height / coefficient))
+    # With reducing_gap, Pillow first shrinks oversized images with the cheap
+    # integer box filter (Image.reduce) and only runs Lanczos on the last
+    # step. Unlike Image.thumbnail, this also upscales small stickers.
+    resized = raw.resize(
+        size,
+        resample=Image.Resampling.LANCZOS,
+        reducing_gap=2.0,
+    )
+    # Fully opaque stickers don't need an alpha channel, and encode much
+    # smaller as a 256 colors palette image
+    if (
+        resized.mode == "RGBA"
+        and resized.getchannel("A").getextrema()[0] == 255
+    ):
+        resized = resized.convert("RGB").quantize(
+            colors=256,
+            method=_QUANTIZE_METHOD,
+        )
+    # Most stickers are well under the 512 kilobytes limit even with the
+    # fastest zlib level, so only pay for a thorough compression if needed.
+    # The PNG is encoded in memory so that the file is written only once.
+    buffer = io.BytesIO()
+    resized.save(buffer, format="PNG", compress_level=1)
+    if buffer.tell() > 512 * 1024:
+        buffer = io.BytesIO()
+        resized.save(buffer, format="PNG", compress_level=9, optimize=True)
+    resized_path.write_bytes(buffer.getvalue())
+    return resized_path
+
+
+async def resize_stickers(
+    stickers: Stickers,
+    download_directory: Path,
+    in_queue: asyncio.Queue,
+    out_queue: asyncio.Queue,
+    progress: Progress,
+) -> Stickers:
     """A Telegram sticker must be a PNG image up to 512 kilobytes in size,
     dimensions must not exceed 512px, and either width or height must be
     exactly 512px. (source
     https://python-telegram-bot.readthedocs.io/en/stable/telegram.bot.html?highlight=create#telegram.Bot.add_sticker_to_set)
+
+    Stickers are resized in parallel, one process per CPU core, as their
+    indices come out of `in_queue`, until `None` is received. The index of
+    each sticker is put in `out_queue` once it is resized, and `None` is put
+    last.
     """
-    for sid in track(sticker_data.keys(), "📐 Resizing..."):
-        raw_path = sticker_data[sid]["raw_path"]
-        if raw_path is None:
-            sticker_data[sid]["resized_path"] = None
-            continue
-        resized_path = download_directory / f"{sid}.resized.png"
-        raw = Image.open(raw_path)
-        coefficient = max(raw.width, raw.height) / 512
-        size = (int(raw.width / coefficient), int(raw.height / coefficient))
-        resized = raw.resize(size, resample=Image.LANCZOS)
-        resized.save(resized_path)
-        sticker_data[sid]["resized_path"] = resized_path
-    return sticker_data
+    loop = asyncio.get_running_loop()
+
+    async def _resize(executor: ProcessPoolExecutor, i: int) -> None:
+        raw_path = stickers.raw_paths[i]
+        resized_path = download_directory / f"{stickers.sids[i]}.resized.png"
+        if raw_path is not None:
+            if (
+                resized_path.is_file()
+                and resized_path.stat().st_mtime >= raw_path.stat().st_mtime
+            ):
+                # Already resized by a previous run, and the raw sticker
+                # hasn't been downloaded again since
+                stickers.resized_paths[i] = resized_path
+            else:
+                stickers.resized_paths[i] = await loop.run_in_executor(
+                    executor,
+                    _resize_one,
+                    raw_path,
+                    resized_path,
+                )
+        progress.advance(task)
+        await out_queue.put(i)
+
+    task = progress.add_task("📐 Resizing...", total=len(stickers))
+    with ProcessPoolExecutor() as executor:
+        tasks = []
+        while (i := await in_queue.get()) is not None:
+            tasks.append(asyncio.create_task(_resize(executor, i)))
+        await asyncio.gather(*tasks)
+    await out_queue.put(None)
+    return stickers
 
 
 if __name__ == "__main__":